@@ -1,9 +1,16 @@
 import pytest
 from tombstone import Tombstone
+from tombstone.tombstone import _ChangeHandler
+from types import SimpleNamespace
+from unittest import mock
+import pika
 import tempfile
 import os
 import time
 import shutil
+import json
+import gc
+import threading
 
 def test_tombstone():
 
@@ -47,5 +54,321 @@ def test_tombstone():
 
     assert os.path.basename(t2.monitor[0]['name']) == 'b'
 
+def test_walk_to_depth():
+
+    dir = tempfile.TemporaryDirectory()
+    os.makedirs(os.path.join(dir.name, 'a', 'b', 'c'))
+    open(os.path.join(dir.name, 'a', 'x.txt'), 'w').close()
+
+    t = Tombstone(dir.name,1,1,0.1)
+    walked = list(t.walk_to_depth(os.path.join(dir.name, 'a'), 1))
+
+    roots = [os.path.basename(r) for r, _, _, _ in walked]
+    assert roots == ['a', 'b']
+    assert [x[3] for x in walked] == [0, 1]
+    assert [x.name for x in walked[0][1]] == ['b']
+    assert [x.name for x in walked[0][2]] == ['x.txt']
+    assert [x.name for x in walked[1][1]] == ['c']
+
+    # entries have full paths and can be used after the walk
+    x_txt = walked[0][2][0]
+    assert x_txt.path == os.path.join(dir.name, 'a', 'x.txt')
+    assert x_txt.stat(follow_symlinks=False).st_mtime == os.path.getmtime(x_txt.path)
+    c = walked[1][1][0]
+    assert c.path == os.path.join(dir.name, 'a', 'b', 'c')
+    assert c.stat(follow_symlinks=False).st_ino == os.stat(c.path).st_ino
+
+    dir.cleanup()
+
+def test_tombstone_cache():
+
+    dir = tempfile.TemporaryDirectory()
+    dir_a = os.path.join(dir.name, 'a')
+    os.makedirs(dir_a)
+    os.utime(dir_a, (time.time()-10, time.time()-10))
+
+    t = Tombstone(dir.name,1,0,5)
+    t.filename = "done.txt"
+    x = t.update(True)
+    assert x == [os.path.join(dir_a, "done.txt")]
+
+    # removing the tombstone is not noticed once the directory is cached
+    os.remove(x[0])
+    assert t.update(True) == []
+    assert len(t.monitor) == 0
+
+    # changing the filename clears the cache
+    os.utime(dir_a, (time.time()-10, time.time()-10))
+    t.filename = "done.txt"
+    assert t.update(True) == x
+
+    dir.cleanup()
+
+def test_recreated_dir():
+
+    dir = tempfile.TemporaryDirectory()
+    study = os.path.join(dir.name, 'study1')
+    os.makedirs(study)
+    os.utime(study, (time.time()-10, time.time()-10))
+
+    t = Tombstone(dir.name,1,0,5)
+    t.filename = "done.txt"
+    tomb = os.path.join(study, "done.txt")
+    assert t.update(True) == [tomb]
+    assert t.update(True) == []
+
+    # a removed and re-sent study is tombstoned again, even if the inode is reused
+    shutil.rmtree(study)
+    os.makedirs(study)
+    os.utime(study, (time.time()-10, time.time()-10))
+    assert t.update(True) == [tomb]
+
+    # and directories that are gone are forgotten
+    shutil.rmtree(study)
+    t.update(True)
+    assert len(t._tombstoned) == 0
+
+    dir.cleanup()
+
+def test_update_dirs():
+
+    dir = tempfile.TemporaryDirectory()
+    dir_a = os.path.join(dir.name, 'a')
+    dir_b = os.path.join(dir.name, 'b')
+    os.makedirs(os.path.join(dir_a, 'c'))
+    os.makedirs(dir_b)
+    for d in [dir_a, dir_b]:
+        os.utime(d, (time.time()-10, time.time()-10))
+
+    t = Tombstone(dir.name,1,0,5)
+    t.filename = "done.txt"
+    assert t.monitored_dir(os.path.join(dir_a, 'c', 'x.txt')) == dir_a
+    assert t.monitored_dir(dir.name) is None
+
+    x = t.update_dirs([dir_b], True)
+    assert x == [os.path.join(dir_b, "done.txt")]
+    assert not os.path.exists(os.path.join(dir_a, "done.txt"))
+
+    # files and symlinks at the monitored level are not monitored
+    notes = os.path.join(dir.name, 'notes.txt')
+    link = os.path.join(dir.name, 'link')
+    open(notes, 'w').close()
+    os.symlink(dir_a, link)
+    for x in [notes, link]:
+        os.utime(x, (time.time()-10, time.time()-10), follow_symlinks=False)
+    assert t.monitored_dir(notes) == notes
+    assert t.update_dirs([notes, link], True) == []
+    assert len(t.monitor) == 0
+    assert not os.path.exists(os.path.join(dir_a, "done.txt"))
+
+    dir.cleanup()
+
+def test_change_handler():
+
+    dir = tempfile.TemporaryDirectory()
+    dir_a = os.path.join(dir.name, 'a')
+    dir_b = os.path.join(dir.name, 'b')
+    t = Tombstone(dir.name,1,0,5)
+    handler = _ChangeHandler(t)
+
+    def event(event_type, src_path, dest_path=''):
+        return SimpleNamespace(event_type=event_type, src_path=src_path, dest_path=dest_path)
+
+    # reads, including our own scans, are ignored
+    handler.dispatch(event('opened', os.path.join(dir_a, 'x.dcm')))
+    handler.dispatch(event('closed_no_write', os.path.join(dir_a, 'x.dcm')))
+    assert handler.pop() == set()
+
+    # changes below a monitored dir mark it dirty, but do not replace it
+    handler.dispatch(event('created', os.path.join(dir_a, 'x.dcm')))
+    handler.dispatch(event('modified', dir.name))
+    assert handler.pop() == {dir_a}
+    assert handler.pop_removed() == set()
+    assert handler.pop() == set()
+
+    # moves mark both ends, and moving the monitored dir itself replaces it
+    handler.dispatch(event('moved', os.path.join(dir_a, 'x.dcm'), os.path.join(dir_b, 'x.dcm')))
+    assert handler.pop() == {dir_a, dir_b}
+    handler.dispatch(event('moved', dir.name + '_incoming', dir_b))
+    handler.dispatch(event('deleted', dir_a))
+    assert handler.pop() == {dir_a, dir_b}
+    assert handler.pop_removed() == {dir_a, dir_b}
+
+    dir.cleanup()
+
+def test_change_handler_rescan():
+
+    dir = tempfile.TemporaryDirectory()
+    dir_a = os.path.join(dir.name, 'a')
+    dir_b = os.path.join(dir.name, 'b')
+    os.makedirs(dir_a)
+    os.makedirs(dir_b)
+    old = time.time() - 10
+    os.utime(dir_b, (old, old))
+
+    t = Tombstone(dir.name,1,0,5)
+    t.filename = "done.txt"
+    handler = _ChangeHandler(t)
+
+    # first scan checks everything, a is not static yet
+    assert handler.rescan(True) == [os.path.join(dir_b, "done.txt")]
+    assert handler._pending == {dir_a}
+
+    # a is rechecked without any events until it gets a tombstone
+    assert handler.rescan(True) == []
+    assert [x['name'] for x in t.monitor] == [dir_a]
+    os.utime(dir_a, (old, old))
+    assert handler.rescan(True) == [os.path.join(dir_a, "done.txt")]
+    assert handler._pending == set()
+
+    # then only directories with events are checked
+    dir_c = os.path.join(dir.name, 'c')
+    os.makedirs(dir_c)
+    handler.dispatch(SimpleNamespace(event_type='created', src_path=dir_c, dest_path=''))
+    assert handler.rescan(True) == []
+    assert [x['name'] for x in t.monitor] == [dir_c]
+
+    dir.cleanup()
+
+def test_incremental():
+
+    dir = tempfile.TemporaryDirectory()
+    dir_a = os.path.join(dir.name, 'a')
+    dir_c = os.path.join(dir_a, 'c')
+    os.makedirs(dir_c)
+    old = time.time() - 10
+    os.utime(dir_c, (old, old))
+    os.utime(dir_a, (old, old))
+
+    t = Tombstone(dir.name,1,0,5)
+    t.incremental = True
+    t.update(False)
+    assert t.monitor[0]['age'] > 5
+
+    # touching a subdirectory is not seen while the monitored dir is unchanged
+    os.utime(dir_c)
+    t.update(False)
+    assert t.monitor[0]['age'] > 5
+
+    t.incremental = False
+    t.update(False)
+    assert t.monitor[0]['age'] < 5
+
+    # walks are forgotten once tombstoned, deleted or forgotten
+    t.incremental = True
+    t.filename = "done.txt"
+    dirs = [os.path.join(dir.name, f'd{i}') for i in range(3)]
+    for d in dirs:
+        os.makedirs(os.path.join(d, 'c'))
+        os.utime(os.path.join(d, 'c'), (old, old))
+        os.utime(d, (old, old))
+    t.depth = 1
+    t.update_dirs(dirs[:1], False)
+    assert dirs[0] in t._mtime_cache
+    assert t.update_dirs(dirs[:1], True) == [os.path.join(dirs[0], "done.txt")]
+    assert dirs[0] not in t._mtime_cache
+
+    t.update_dirs(dirs[1:], False)
+    assert dirs[1] in t._mtime_cache and dirs[2] in t._mtime_cache
+    shutil.rmtree(dirs[1])
+    t.update_dirs(dirs[1:2], False)
+    t.forget(dirs[2:])
+    assert len(t._mtime_cache) == 0
+
+    dir.cleanup()
+
+def test_existing_tombstone():
+
+    dir = tempfile.TemporaryDirectory()
+    dir_a = os.path.join(dir.name, 'a')
+    os.makedirs(dir_a)
+    os.utime(dir_a, (time.time()-10, time.time()-10))
+
+    # tombstone from before this process started is found on the first scan
+    open(os.path.join(dir_a, "done.txt"), 'w').close()
+    os.utime(dir_a, (time.time()-10, time.time()-10))
+    t = Tombstone(dir.name,1,0,5)
+    t.filename = "done.txt"
+    assert t.update(True) == []
+    assert len(t.monitor) == 0
+
+    # tombstone created by someone else later is found when creating it
+    dir_b = os.path.join(dir.name, 'b')
+    os.makedirs(dir_b)
+    t.update(True)
+    assert len(t.monitor) == 1
+    open(os.path.join(dir_b, "done.txt"), 'w').close()
+    os.utime(dir_b, (time.time()-10, time.time()-10))
+    assert t.update(True) == []
+    assert len(t.monitor) == 1
+    assert t.update(True) == []
+    assert len(t.monitor) == 0
+
+    # the existence check is still used when only observing
+    t.filename = "done.txt"
+    t.update(False)
+    assert len(t.monitor) == 0
+
+    dir.cleanup()
+
+def test_make_obituary():
+
+    t = Tombstone()
+    msg = json.loads(t.make_obituary("/tmp/a/done.txt"))
+    assert msg['content']['filename'] == "/tmp/a/done.txt"
+
+    # filenames that are not valid UTF-8 are surrogate escaped
+    tombname = os.fsdecode(b'/tmp/x\xff/done.txt')
+    msg = json.loads(t.make_obituary(tombname))
+    assert msg['content']['filename'] == tombname
+
+def test_publisher_connection():
+
+    connections = []
+    def connect(params):
+        c = mock.MagicMock()
+        c.is_open = True
+        c.channel.return_value.is_open = True
+        connections.append(c)
+        return c
+
+    with mock.patch('tombstone.tombstone.pika.BlockingConnection', side_effect=connect):
+        t = Tombstone()
+        t.queue = ['127.0.0.1', 5672, 'tombstone']
+
+        # one connection and queue declaration for all messages
+        t.send_obituaries([f"msg{i}" for i in range(3)])
+        t.send_obituary("msg3")
+        t.flush()
+        assert len(connections) == 1
+        channel = connections[0].channel.return_value
+        channel.queue_declare.assert_called_once_with(queue='tombstone')
+        assert [x.kwargs['body'] for x in channel.basic_publish.call_args_list] == ["msg0", "msg1", "msg2", "msg3"]
+
+        # a dropped stream is reconnected once and the message retried
+        channel.basic_publish.side_effect = pika.exceptions.StreamLostError("lost")
+        t.send_obituary("msg4")
+        t.flush()
+        assert len(connections) == 2
+        connections[0].close.assert_called_once()
+        channel = connections[1].channel.return_value
+        channel.queue_declare.assert_called_once_with(queue='tombstone')
+        assert [x.kwargs['body'] for x in channel.basic_publish.call_args_list] == ["msg4"]
+
+        t.close()
+        connections[1].close.assert_called_once()
+
+def test_publisher_finalized():
+
+    # nothing listens on port 1, messages fail and are logged
+    t = Tombstone()
+    t.queue = ['127.0.0.1', 1, 'tombstone']
+    t.send_obituary(t.make_obituary("/tmp/a/done.txt"))
+    t.flush()
+
+    del t
+    gc.collect()
+    assert "tombstone-publisher" not in [x.name for x in threading.enumerate()]
+
 if __name__ == "__main__":
     pytest.main()
\ No newline at end of file
@@ -1,12 +1,186 @@
 import os
+import stat
 import argparse
-import datetime
+import itertools
 import time
 import logging
 import json
+import threading
+import queue
 import pika
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Scan directories through open file descriptors where the platform allows it
+_SCANDIR_FD = (os.scandir in os.supports_fd) and (os.open in os.supports_dir_fd)
+_DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+
+class _ChangeHandler:
+    """Event handler for a watchdog observer that records which monitored
+    directories have changed since they were last checked
+    """
+
+    # events that do not modify anything, including our own scans
+    _ignored = ('opened', 'closed_no_write')
+
+    # events that may replace a monitored directory with a new one
+    _replaced = ('created', 'deleted', 'moved')
+
+    def __init__(self, tombstone):
+        self._tombstone = tombstone
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._removed = set()
+
+        # directories from the last check still waiting for a tombstone, None before the first scan
+        self._pending = None
+
+    def dispatch(self, event):
+        if event.event_type in self._ignored:
+            return
+
+        for path in (event.src_path, getattr(event, 'dest_path', '')):
+            if path:
+                path = os.fsdecode(path)
+                d = self._tombstone.monitored_dir(path)
+                if d is not None:
+                    with self._lock:
+                        self._dirty.add(d)
+                        if event.event_type in self._replaced and os.path.normpath(path) == d:
+                            self._removed.add(d)
+
+    def pop(self):
+        """Get and clear the set of changed monitored directories"""
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+        return dirty
+
+    def pop_removed(self):
+        """Get and clear the set of monitored directories that were created,
+        deleted or moved
+        """
+        with self._lock:
+            removed = self._removed
+            self._removed = set()
+        return removed
+
+    def rescan(self, make_tombstones=True):
+        """Scan all directories the first time, then only check those that
+        changed or did not get a tombstone in the previous check
+
+        Keyword arguments:
+        make_tombstones: flag to indicate tombstones should be created (default=True)
+        """
+        t = self._tombstone
+        if self._pending is None:
+            tlist = t.update(make_tombstones)
+        else:
+            t.forget(self.pop_removed())
+            tlist = t.update_dirs(sorted(self._pending | self.pop()), make_tombstones)
+
+        # Directories without a new tombstone must be checked again
+        self._pending = {x['name'] for x in t.monitor} - {os.path.dirname(f) for f in tlist}
+
+        return tlist
+
+class _Publisher:
+    """Background thread that publishes messages to a RabbitMQ queue over a
+    single persistent connection. The thread only references this object, so
+    a Tombstone that is no longer used can still be finalized and stop it
+    """
+
+    def __init__(self, host, port, queue_name):
+        self._host = host
+        self._port = port
+        self._queue_name = queue_name
+        self._connection = None
+        self._channel = None
+        self._messages = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="tombstone-publisher", daemon=True)
+        self._thread.start()
+
+    def put(self, message):
+        """Queue a message to be published"""
+        self._messages.put(message)
+
+    def flush(self):
+        """Wait until all queued messages have been sent"""
+        self._messages.join()
+
+    def close(self):
+        """Send any queued messages, then stop the thread and close the connection"""
+        self._messages.put(None)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _get_channel(self):
+        """Get the channel used to publish messages, connecting to RabbitMQ
+        and declaring the queue if there is no open channel
+        """
+
+        if self._channel is None or not self._channel.is_open:
+            self._close_connection()
+            self._connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(
+                        host=self._host,
+                        port=self._port))
+
+            self._channel = self._connection.channel()
+            self._channel.queue_declare(queue=self._queue_name)
+
+        return self._channel
+
+    def _close_connection(self):
+        """Close the RabbitMQ connection if one is open"""
+        if self._connection is not None and self._connection.is_open:
+            try:
+                self._connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+        self._connection = None
+        self._channel = None
+
+    def _run(self):
+        """Publish queued messages until a None is received"""
+        logger = logging.getLogger("tombstone")
+
+        while True:
+            message = self._messages.get()
+            try:
+                if message is None:
+                    self._close_connection()
+                    return
+
+                try:
+                    self._get_channel().basic_publish(exchange='', routing_key=self._queue_name, body=message)
+                except pika.exceptions.AMQPConnectionError:
+                    # connection was dropped (e.g. missed heartbeats between scans), retry once
+                    self._close_connection()
+                    self._get_channel().basic_publish(exchange='', routing_key=self._queue_name, body=message)
+            except Exception as e:
+                logger.error("Failed to send obituary: "+repr(e))
+                self._close_connection()
+            finally:
+                self._messages.task_done()
 
 class Tombstone:
+
+    __slots__ = ('_directory', '_filename', '_level', '_depth', '_monitor', '_static',
+                 '_threshold', '_files', '_queue', '_tombstoned', '_exists_cache', '_parent_mtimes',
+                 '_cache_ttl', '_incremental', '_mtime_cache', '_workers',
+                 '_publisher')
+
     def __init__(self, directory=None, level=1, depth=0, threshold=None):
 
         # base directory to start monitoring
@@ -36,6 +210,41 @@ class Tombstone:
         # Queue name for RabbitMQ messages
         self._queue = None
 
+        # Directories known to already contain a tombstone, mapped to their inode
+        self._tombstoned = {}
+
+        # Inode and time at which each directory was last found without a tombstone
+        self._exists_cache = {}
+
+        # mtimes of the parents of monitored directories when last listed
+        self._parent_mtimes = {}
+
+        # Time (in seconds) to trust a check that found no tombstone
+        self._cache_ttl = None
+
+        # Skip subtree walks for directories whose own mtime is unchanged
+        self._incremental = False
+
+        # Per directory (mtime, newest subtree mtime, walk completed) from the last walk
+        self._mtime_cache = {}
+
+        # Number of threads used to scan monitored directories
+        self._workers = min(32, (os.cpu_count() or 1) * 4)
+
+        # Background publisher for RabbitMQ messages, started on first use
+        self._publisher = None
+
+    @property
+    def cache_ttl(self):
+        """Time (in seconds) to trust a check that found no tombstone (default=None, always check)"""
+        return self._cache_ttl
+
+    @cache_ttl.setter
+    def cache_ttl(self, value: float | None):
+        if value is not None and value < 0:
+            raise ValueError(f'Invalid cache ttl: {value}')
+        self._cache_ttl = value
+
     @property
     def depth(self):
         """How many levels down to check for changes"""
@@ -64,6 +273,9 @@ class Tombstone:
     @filename.setter
     def filename(self, value: str):
         self._filename = value
+        self._tombstoned.clear()
+        self._exists_cache.clear()
+        self._parent_mtimes.clear()
 
     @property
     def files(self):
@@ -74,6 +286,20 @@ class Tombstone:
     def files(self, value: bool):
         self._files = value
 
+    @property
+    def incremental(self):
+        """Flag to reuse the previous subtree walk of a directory whose own mtime
+        has not changed (default=False). Changes that do not modify the monitored
+        directory itself, such as new files in a subdirectory or rewritten files,
+        are only noticed once the directory's own mtime changes
+        """
+        return self._incremental
+
+    @incremental.setter
+    def incremental(self, value: bool):
+        self._incremental = value
+        self._mtime_cache.clear()
+
     @property
     def level(self):
         """How far below base directory to start monitoring"""
@@ -112,6 +338,17 @@ class Tombstone:
             raise ValueError(f'Invalid threhsold: {value}')
         self._threshold = value  
 
+    @property
+    def workers(self):
+        """Number of threads used to scan monitored directories in parallel"""
+        return self._workers
+
+    @workers.setter
+    def workers(self, value: int):
+        if value < 1:
+            raise ValueError(f'Invalid number of workers: {value}')
+        self._workers = value
+
     @property
     def queue(self):
         """List with 3 elements giving RabbitMQ info
@@ -125,12 +362,14 @@ class Tombstone:
 
     @queue.setter
     def queue(self, value: list | None):
+        self.close()
         self._queue=value
 
     # walk through a directory up to the specified depth of levels
     def walk_to_depth(self, directory: str, depth: int):
-        """Walk a directory to a set depth and return mtimes for dirs
-        and optionaly for files
+        """Walk a directory to a set depth and yield (root, dirs, files, current_depth)
+        where dirs and files are lists of os.DirEntry objects with full paths and
+        current_depth is the level of root below directory
 
         Keyword arguments:
         directory: directory to start the walk at
@@ -140,14 +379,153 @@ class Tombstone:
         directory = os.path.normpath(directory)
         assert os.path.isdir(directory)
 
-        base_level = directory.count(os.path.sep)
-        for root, dirs, files in os.walk(directory):
-            current_level = root.count(os.path.sep)
-            yield root, dirs, files
-            if (current_level - base_level) >= depth:
-                del dirs[:]
+        for root, dirs, files, dirfd, current_depth in self._scan_to_depth(directory, depth, use_fd=False):
+            yield root, dirs, files, current_depth
+
+    def _scan_to_depth(self, root: str, depth: int, current_depth: int = 0, name: str | None = None, parent_fd: int | None = None, use_fd=True):
+        """Recursive helper for walk_to_depth that yields (root, dirs, files, dirfd, current_depth)
+        with os.DirEntry lists. Where supported and use_fd is set, each directory
+        is scanned through an open file descriptor, so entry.stat() only resolves
+        the entry name relative to dirfd. The entries then have bare names as
+        paths and can only be stat'd before the walk is resumed past their
+        directory, since dirfd is closed after that. Otherwise dirfd is None
+
+        Keyword arguments:
+        root: directory to scan
+        depth: max levels of subdirectories to traverse
+        current_depth: level of root below the start of the walk
+        name: name of root relative to parent_fd
+        parent_fd: open file descriptor for the parent of root
+        use_fd: flag to scan through directory file descriptors (default=True)
+        """
+
+        dirfd = None
+        dirs = []
+        files = []
+        try:
+            if use_fd and _SCANDIR_FD:
+                if parent_fd is None:
+                    dirfd = os.open(root, _DIR_FLAGS)
+                else:
+                    dirfd = os.open(name, _DIR_FLAGS, dir_fd=parent_fd)
+
+            # bind methods locally, this loop runs once per entry in the subtree
+            add_dir = dirs.append
+            add_file = files.append
+            with os.scandir(root if dirfd is None else dirfd) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        add_dir(entry)
+                    else:
+                        add_file(entry)
+        except OSError:
+            # directory vanished or is unreadable, skip it like os.walk does
+            if dirfd is not None:
+                os.close(dirfd)
+            return
+
+        try:
+            yield root, dirs, files, dirfd, current_depth
+
+            if current_depth < depth:
+                # build child paths by concatenation, like os.walk does internally
+                prefix = root if root.endswith(os.sep) else root + os.sep
+                for entry in dirs:
+                    yield from self._scan_to_depth(prefix + entry.name, depth, current_depth + 1, entry.name, dirfd, use_fd)
+        finally:
+            if dirfd is not None:
+                os.close(dirfd)
+
+    def _min_age(self, path: str, age: float, timestamp: float, cutoff: float):
+        """Get the age of the most recently modified entry below a monitored
+        directory. The walk stops as soon as an entry newer than cutoff is
+        found, in which case the age of the newest entry seen so far is
+        returned since the directory can no longer be static
+
+        Keyword arguments:
+        path: monitored directory to examine
+        age: age of the monitored directory itself
+        timestamp: reference time for the current scan
+        cutoff: mtime after which an entry is too recent to be static
+        """
+
+        top_mtime = timestamp - age
+        if top_mtime > cutoff:
+            return age
+
+        # a cached walk is reused if it either completed or already shows the
+        # directory is too recent to be static
+        if self._incremental:
+            cached = self._mtime_cache.get(path)
+            if cached is not None and cached[0] == top_mtime and (cached[2] or cached[1] > cutoff):
+                return timestamp - cached[1]
+
+        newest = top_mtime
+        completed = True
+        check_files = self.files
+        # path is a directory entry from this scan, so skip the normpath/isdir checks of walk_to_depth,
+        # and entries are only stat'd while their directory fd is still open
+        for root, dirs, files, dirfd, current_depth in self._scan_to_depth(path, self.depth):
+
+            # get age for all subdirectories and optionally all files
+            entries = dirs + files if check_files else dirs
+            for entry in entries:
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+                if mtime > newest:
+                    newest = mtime
+                if mtime > cutoff:
+                    completed = False
+                    break
+
+            if not completed:
+                break
+
+        if self._incremental:
+            self._mtime_cache[path] = (top_mtime, newest, completed)
+
+        return timestamp - newest
+
+    def _has_tombstone(self, directory: str, inode: int, recheck=True):
+        """Check if a directory contains a tombstone file, using cached results
+        where possible
+
+        Keyword arguments:
+        directory: directory to check
+        inode: inode of the directory, so a recreated directory is checked again
+        recheck: flag to check again after cache_ttl when no tombstone was found,
+            otherwise a directory is only checked the first time it is seen (default=True)
+        """
+
+        if self._tombstoned.get(directory) == inode:
+            return True
+
+        now = time.time()
+        checked = self._exists_cache.get(directory)
+        if checked is not None and checked[0] == inode:
+            if not recheck or (self._cache_ttl is not None and (now - checked[1]) < self._cache_ttl):
+                return False
+
+        if os.path.exists(directory + os.sep + self.filename):
+            self._tombstoned[directory] = inode
+            self._exists_cache.pop(directory, None)
+            return True
+
+        self._exists_cache[directory] = (inode, now)
+        return False
 
-    def get_dirs_list(self, directories: list, levels: int, continuous: bool):
+    def forget(self, directories):
+        """Drop cached tombstone checks, e.g. for directories that were deleted
+        or replaced
+
+        Keyword arguments:
+        directories: directories to forget
+        """
+        for x in directories:
+            self._tombstoned.pop(x, None)
+            self._exists_cache.pop(x, None)
+            self._mtime_cache.pop(x, None)
+
+    def get_dirs_list(self, directories: list, levels: int, continuous: bool, make_tombstones=False):
         """Get the list of directories to monitor. These are subdirectories that
         are the specified number of levels below the base directory
         and do not currently contain a tombstone file
@@ -156,24 +534,58 @@ class Tombstone:
         directories: list directories to check
         levels: how far down to check
         continuous: flag to check all subdirs instead of just at level of depth
+        make_tombstones: flag to only check directories for a tombstone the first
+            time they are seen, since later ones are detected when creating them (default=False)
+
+        Returns a list of dicts with the 'name' of each directory and its mtime
+        as 'age'. The mtime is read once from the scandir entry, and the subtree
+        walk in update starts from the contents of each directory, so no path
+        is stat'd twice in a scan
+        """
+        outlist = self._get_dirs(directories, levels, continuous, make_tombstones)
+        return([ {'name':x.path, 'age': x.stat(follow_symlinks=False).st_mtime} for x in outlist ])
+
+    def _get_dirs(self, directories: list, levels: int, continuous: bool, make_tombstones: bool):
+        """Get the os.DirEntry of each directory to monitor, see get_dirs_list.
+        Cached tombstone checks are dropped for directories that are no longer
+        listed, and for children of parents whose mtime changed since they
+        were last listed, since an entry may have been deleted and recreated
+        with the same inode
         """
         dlevel = 0
         outlist = []
         finished = False
         dlist = directories
+        scandir = os.scandir
+        parents = {}
+        stale = set()
 
         while (dlevel < levels) and not finished:
 
+            # parents whose entries are returned, mtime is read before listing
+            record = continuous or (dlevel + 1 == levels)
+
             ilist = []
             for d in dlist:
-                ilist = ilist + [os.path.join(d,x) for x in os.listdir(d) if os.path.isdir(os.path.join(d,x))]
+                changed = False
+                if record:
+                    key = os.fspath(d)
+                    parents[key] = os.stat(d).st_mtime
+                    changed = self._parent_mtimes.get(key) != parents[key]
+
+                with scandir(d) as it:
+                    for e in it:
+                        if e.is_dir(follow_symlinks=False):
+                            ilist.append(e)
+                            if changed:
+                                stale.add(e.path)
 
             finished = len(ilist) == 0 
 
             dlevel = dlevel + 1
             if not finished:
                 if continuous:
-                    outlist = outlist + ilist
+                    outlist.extend(ilist)
                 else:
                     if dlevel == levels:
                         outlist = ilist
@@ -181,8 +593,16 @@ class Tombstone:
             dlist = ilist
 
         if self.filename is not None:   
-            outlist = [x for x in outlist if not os.path.exists(os.path.join(x,self.filename))]
-        outlist = [ {'name':x, 'age': os.path.getmtime(x)} for x in outlist ]
+
+            # forget checks for directories that are gone or may have been replaced
+            listed = {x.path: x.inode() for x in outlist}
+            self._tombstoned = {k: v for k, v in self._tombstoned.items() if listed.get(k) == v and k not in stale}
+            self._exists_cache = {k: v for k, v in self._exists_cache.items() if listed.get(k) == v[0] and k not in stale}
+            self._parent_mtimes = parents
+
+            has_tombstone = self._has_tombstone
+            recheck = not make_tombstones
+            outlist = [x for x in outlist if not has_tombstone(x.path, x.inode(), recheck)]
 
         return(outlist)
 
@@ -195,31 +615,60 @@ class Tombstone:
 
         content = {
             "sender" : "tombstone",
-            "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
             "filename": tombname
             }
 
         msg={"role": "user", "content": content}
-        msg_str = json.dumps(msg)
+        msg_str = None
+        if orjson is not None:
+            try:
+                msg_str = orjson.dumps(msg).decode()
+            except orjson.JSONEncodeError:
+                # e.g. surrogate escaped non UTF-8 filenames, which json can encode
+                pass
+        if msg_str is None:
+            msg_str = json.dumps(msg)
         return(msg_str)
 
-    def send_obituary(self, obituary):
-        """Send a message about a new tombstone
+    def flush(self):
+        """Wait until all queued messages have been sent"""
+        if self._publisher is not None:
+            self._publisher.flush()
+
+    def close(self):
+        """Send any queued messages, then stop the publisher and close
+        the RabbitMQ connection
+        """
+        if self._publisher is not None:
+            self._publisher.close()
+            self._publisher = None
+
+    def __del__(self):
+        self.close()
+
+    def send_obituaries(self, obituaries: list):
+        """Queue messages about new tombstones to be sent by a background
+        publisher over a single connection
 
         Keyword arguments:
-        obituary: message to send out
+        obituaries: list of messages to send out
         """
         if self.queue is not None:
 
-            connection = pika.BlockingConnection( 
-                    pika.ConnectionParameters(
-                        host=self.queue[0], 
-                        port=self.queue[1]))
+            if self._publisher is None:
+                self._publisher = _Publisher(self.queue[0], self.queue[1], self.queue[2])
+
+            for obituary in obituaries:
+                self._publisher.put(obituary)
 
-            channel = connection.channel()
-            channel.queue_declare(queue=self.queue[2])
-            channel.basic_publish(exchange='', routing_key=self.queue[2], body=obituary)
-            connection.close()
+    def send_obituary(self, obituary):
+        """Send a message about a new tombstone
+
+        Keyword arguments:
+        obituary: message to send out
+        """
+        self.send_obituaries([obituary])
 
     def update(self, make_tombstones=True):
         """Scan all directories to check for static condition
@@ -228,39 +677,96 @@ class Tombstone:
         make_tombstones: flag to indicate tombstones should be created (default=True)
         """
         # current timestamp for reference
-        timestamp = datetime.datetime.now().timestamp()
+        timestamp = time.time()
 
         # If only monitoring the base directory
         if self._level == 0:
              return([[self._directory, timestamp-os.path.getmtime(self._directory)]])
         
         # get last mod time for directories of interest
-        self.monitor = self.get_dirs_list([self.directory], self.level, False)
+        entries = self._get_dirs([self.directory], self.level, False, make_tombstones)
+        self.monitor = [ {'name':x.path, 'age': x.stat(follow_symlinks=False).st_mtime} for x in entries ]
+        inodes = {x.path: x.inode() for x in entries}
 
-        # Get age in seconds of each directory
-        for d in range(len(self.monitor)):
-            self.monitor[d]['age'] = timestamp - self.monitor[d]['age']
+        # forget walks of directories that are no longer monitored
+        if len(self._mtime_cache) > 0:
+            names = {x['name'] for x in self.monitor}
+            self._mtime_cache = {k: v for k, v in self._mtime_cache.items() if k in names}
 
-        # Examine subdirectories and files for more recent mtimes
-        for d in range(len(self.monitor)):
+        return(self._check_monitor(timestamp, make_tombstones, inodes))
 
-            for root, dirs, files in self.walk_to_depth(self.monitor[d]['name'], self.depth):
+    def update_dirs(self, directories: list, make_tombstones=True):
+        """Check only the given monitored directories for static condition,
+        e.g. those reported as changed by a filesystem observer
 
-                # get age for all subdirectories
-                for subdir in dirs:
-                    age = timestamp - os.path.getmtime(os.path.join(root, subdir))
-                    if age < self.monitor[d]['age']:
-                        self.monitor[d]['age']=age
+        Keyword arguments:
+        directories: monitored directories to check
+        make_tombstones: flag to indicate tombstones should be created (default=True)
+        """
+        # current timestamp for reference
+        timestamp = time.time()
+
+        self.monitor = []
+        inodes = {}
+        for x in directories:
+            try:
+                st = os.stat(x, follow_symlinks=False)
+            except FileNotFoundError:
+                st = None
+
+            # only real directories are monitored, as in get_dirs_list
+            if st is None or not stat.S_ISDIR(st.st_mode):
+                self.forget([x])
+                continue
 
-                # optionally get age of all files
-                if self.files:
-                    for f in files:
-                        age = timestamp - os.path.getmtime(os.path.join(root, f))
-                        if age < self.monitor[d]['age']:
-                            self.monitor[d]['age']=age                        
+            if self.filename is not None:
+                if self._has_tombstone(x, st.st_ino, not make_tombstones):
+                    continue
+
+            self.monitor.append({'name': x, 'age': st.st_mtime})
+            inodes[x] = st.st_ino
+
+        return(self._check_monitor(timestamp, make_tombstones, inodes))
+
+    def monitored_dir(self, path: str):
+        """Get the monitored directory that contains a path, or None if the
+        path is not within a monitored directory
+
+        Keyword arguments:
+        path: file or directory below the base directory
+        """
+        rel = os.path.relpath(path, self.directory)
+        parts = rel.split(os.sep)
+        if self.level < 1 or len(parts) < self.level or parts[0] in (os.curdir, os.pardir):
+            return None
+
+        return os.path.join(self.directory, *parts[:self.level])
+
+    def _check_monitor(self, timestamp: float, make_tombstones: bool, inodes: dict):
+        """Update ages of the directories in monitor and create tombstones
+        for those that are static
+
+        Keyword arguments:
+        timestamp: reference time for the current scan
+        make_tombstones: flag to indicate tombstones should be created
+        inodes: inode of each directory in monitor
+        """
+
+        # Get age in seconds of each directory, then examine subdirectories
+        # and files for more recent mtimes
+        cutoff = timestamp - self.threshold
+        names = [x['name'] for x in self.monitor]
+        ages = [timestamp - x['age'] for x in self.monitor]
+        if self.workers > 1 and len(names) > 1:
+            # scans are independent and spend their time in syscalls that release the GIL
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(names))) as pool:
+                ages = list(pool.map(self._min_age, names, ages, itertools.repeat(timestamp), itertools.repeat(cutoff)))
+        else:
+            ages = [self._min_age(n, a, timestamp, cutoff) for n, a in zip(names, ages)]
 
         # Sort with oldest first
-        self.monitor.sort(key=lambda x: x['age'])
+        order = sorted(range(len(ages)), key=ages.__getitem__)
+        self.monitor = [{'name': names[i], 'age': ages[i]} for i in order]
 
         # get dirs considered "static"
         self.static = [x for x in self.monitor if x['age'] > self.threshold ]
@@ -270,15 +776,27 @@ class Tombstone:
         if make_tombstones:
             for d in self.static:
                 tombname = os.path.join(d['name'], self.filename)
-                with open(tombname, 'w') as f:
-                    retlist.append(tombname)
 
-                    # Add notification here
-                    msglist.append(self.make_obituary(tombname))
+                # create atomically so only one scanner creates a given tombstone
+                try:
+                    os.close(os.open(tombname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                    created = True
+                except FileExistsError:
+                    created = False
+
+                self._tombstoned[d['name']] = inodes[d['name']]
+                self._exists_cache.pop(d['name'], None)
+                self._mtime_cache.pop(d['name'], None)
+                if not created:
+                    continue
+
+                retlist.append(tombname)
+
+                # Add notification here
+                msglist.append(self.make_obituary(tombname))
                     
         if len(msglist) > 0:
-            for m in msglist:
-                self.send_obituary(m)
+            self.send_obituaries(msglist)
                 
         return(retlist)
     
@@ -295,6 +813,9 @@ def main():
     parser.add_argument("--files", '-f', action='store_true', help="Check all file mtimes", default=False)
     parser.add_argument("--info", '-i', action='store_true', help="List info but don't create tombstones")
     parser.add_argument("--wait", '-w', type=int, help="Time (s) between scans for static directories", default=None)
+    parser.add_argument("--cache", '-c', type=float, help="Time (s) to trust a check that found no tombstone", default=None)
+    parser.add_argument("--inotify", '-n', action='store_true', help="Only recheck directories with filesystem events (requires watchdog)")
+    parser.add_argument("--incremental", '-r', action='store_true', help="Skip subtree scans of directories whose own mtime is unchanged")
     parser.add_argument("--logging", '-g', type=str, help="Filename for logging output", default=None)
     parser.add_argument("--queue", '-q', type=str, nargs=3, help="RabbitMQ info: IP port queue_name", default=None)
     parser.add_argument("--verbose", '-v', action='store_true', help="Verbose output")
@@ -318,6 +839,8 @@ def main():
     t.filename = args.tombstone
     t.files = args.files
     t.queue = args.queue
+    t.cache_ttl = args.cache
+    t.incremental = args.incremental
     make_tombstones = (args.tombstone is not None) and (not args.info)
     scanning=True
 
@@ -328,12 +851,32 @@ def main():
         if args.wait is not None:
             logger.info("Scanning frequency: "+str(args.wait)+'s')
 
+    # Watch for filesystem events instead of rescanning everything
+    observer = None
+    handler = None
+    if args.inotify and args.wait is not None and args.level > 0:
+        if Observer is None:
+            logger.warning("watchdog is not installed, falling back to polling")
+        else:
+            handler = _ChangeHandler(t)
+            observer = Observer()
+            observer.schedule(handler, args.path, recursive=True)
+            try:
+                observer.start()
+            except OSError as e:
+                logger.warning("Unable to watch for events, falling back to polling: "+str(e))
+                observer = None
+                handler = None
+
     # Scan directories
     n_monitor=-1
     while scanning:
 
         scanning = args.wait is not None
-        tlist = t.update(make_tombstones)
+        if handler is None:
+            tlist = t.update(make_tombstones)
+        else:
+            tlist = handler.rescan(make_tombstones)
 
         if logger is not None:
             for f in tlist:
@@ -349,6 +892,11 @@ def main():
         if scanning:
             time.sleep(args.wait)
 
+    if observer is not None:
+        observer.stop()
+        observer.join()
+    t.close()
+
 
 if __name__ == "__main__":
     main()